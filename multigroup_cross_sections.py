@@ -6,17 +6,171 @@ Autores: E. Marqués
 Fecha:   11/01/2025
 """
 
+import functools
+import logging
+
 import numpy as np
-import pandas as pd
+
+_LOG = logging.getLogger(__name__)
+
+_MEC_KEV = np.float64(511.006)   # electron rest mass [keV]
+_RE2 = np.float64(0.07939827)    # classical electron radius squared [barn]
+_L = np.float64(0.40061)         # N_A times Thomson cross section [cm^2 mole^-1]
+
+# photoelectric cross sections fitting parameters of each element (read-only)
+# columns: START [keV], FINISH [keV], A_1, A_2, A_3, A_4
+# Biggs F, Lighthill R. Analytical approximations for x-ray cross sections III. 
+# Sandia Natl. Lab., vol. SAND87, no. 70; 1988.
+_PE_TABLES = {
+    'H':np.array(
+        [[0.01,0.014,1.000E-08,0.,0.,0.],\
+         [0.014,0.1,-6.383E+01,-6.446E+00,1.317E+01,-5.045E-02],\
+         [0.1,0.8,3.051E+00,-7.818E+00,1.144E+01,6.959E-02],\
+         [0.8,4.,7.636E-02,-9.406E-01,6.144E+00,1.425E+00],\
+         [4.,20.,1.180E-03,-8.236E-02,2.886E+00,5.534E+00],\
+         [20.,100.,1.620E-05,-5.610E-03,1.214E+00,1.761E+01],\
+         [100.,500.,1.034E-06,-4.114E-04,6.287E-01,3.927E+01]],\
+        dtype=np.float64),\
+    'O':np.array(
+        [[0.01,0.0483,1.144E+04,0.,0.,0.],\
+         [0.0483,0.532,-2.863E+02,4.085E+02,4.436E+01,-1.782E+00],\
+         [0.532,4.,-7.181E+01,4.748E+02,5.542E+03,-1.363E+03],\
+         [4.,20.,2.745E+00,-1.747E+02,7.159E+03,-2.213E+03],\
+         [20.,100.,3.774E-02,-1.559E+01,4.045E+03,1.810E+04],\
+         [100.,500.,3.169E-03,1.473E+00,7.214E+02,4.048E+05]],\
+        dtype=np.float64),\
+    'Al':np.array(
+        [[0.01,0.0159,-1.654E+04,1.585E+02,3.907E+00,-3.383E-02],\
+         [0.0159,0.073,1.122E+03,-4.015E+01,6.623E-01,-2.813E-03],\
+         [0.073,0.1177,2.390E+04,-6.953E+02,-7.978E+01,1.974E+00],\
+         [0.1177,1.560,-5.284E+02,1.399E+03,4.360E+02,-4.747E+01],\
+         [1.560,20.,-3.674E+00,-1.622E+01,2.732E+04,-1.752E+04],\
+         [20.,100.,4.158E-01,-1.351E+02,2.716E+04,3.723E+02],\
+         [100.,500.,1.125E-02,2.747E+00,1.174E+04,5.695E+05]],\
+        dtype=np.float64)
+    }
+for _table in _PE_TABLES.values():
+    _table.setflags(write=False)
+del _table
+
+try:
+    from numba import njit
+except ImportError: # numba is optional: the kernels then run as plain Python
+    def njit(*args,**kwargs):
+        def decorator(function):
+            return function
+        return decorator
+
+# element symbols and weight fractions of a compound, cached by compound
+# (bounded, as weights computed per cell or density give many distinct keys)
+# compound_items: sorted tuple of (element,weight fraction) pairs
+@functools.lru_cache(maxsize=256)
+def _compound_weights(compound_items):
+    elements = tuple(element for element, _ in compound_items)
+    weights = np.array([weight for _, weight in compound_items],\
+                       dtype=np.float64)
+    weights.setflags(write=False)
+    return elements, weights
+
+# photoelectric mass absorption coefficient of an element [cm^2 g^-1] at a
+# single energy, from the Biggs-Lighthill fitting parameters
+# E:      energy [keV], already checked to lie in the fitting domain
+# starts: START energies of the fitting intervals [keV]
+# coefs:  A_1..A_4 coefficients of the fitting intervals
+@njit(cache=True,fastmath=True)
+def _pe_xs(E,starts,coefs):
+    idx = 0
+    while idx+1<starts.shape[0] and starts[idx+1]<E:
+        idx += 1
+    invE = 1./E
+    return invE*(coefs[idx,0]+invE*(coefs[idx,1]+\
+                 invE*(coefs[idx,2]+invE*coefs[idx,3])))
+
+# Biggs-Lighthill scattering fit R/L (scalar or array)
+# X: energy in units of the electron rest mass
+@njit(cache=True,fastmath=True)
+def _scattering_fit(X):
+    return (1.+X*(1.148+X*0.06141))/(1.+X*(3.171+X*(0.9328+X*0.02572)))
+
+# mass attenuation coefficient of an element [cm^2 g^-1] at a single energy:
+# photoelectric absorption plus scattering
+# E:      energy [keV]
+# starts: START energies of the fitting intervals [keV]
+# coefs:  A_1..A_4 coefficients of the fitting intervals
+# LZoA:   L*(Z/A) of the element [cm^2 g^-1]
+@njit(cache=True,fastmath=True)
+def _mu_total_xs(E,starts,coefs,LZoA):
+    return _pe_xs(E,starts,coefs)+LZoA*_scattering_fit(E/_MEC_KEV)
+
+# return the cosine between two unit direction vectors; a vector whose
+# squared norm differs from 1 by more than 1e-12 raises ValueError, and the
+# round-off of the dot product is clipped to [-1,1]
+def _scattering_cosine(direction_in,direction_out):
+    for direction in (direction_in,direction_out):
+        if not abs(float(np.dot(direction,direction))-1.)<=1e-12:
+            raise ValueError('direction_in and direction_out must be unit vectors')
+    chi_m = float(np.dot(direction_in,direction_out))
+    return min(max(chi_m,-1.),1.)
+
+# outgoing energy E_out* = mec/(lambda_in+1-chi_m) [keV] fixed by the angular
+# delta function, or 0 when it falls outside the outgoing group
+# Ei:         incoming energy [keV]
+# E_out_low:  lower (excluded) energy bound of the outgoing group [keV]
+# E_out_high: upper (included) energy bound of the outgoing group [keV]
+# mec:        electron rest mass [keV]
+# chi_m:      cosine between the incoming and outgoing directions
+@njit(cache=True,fastmath=True)
+def _delta_E_out(Ei,E_out_low,E_out_high,mec,chi_m):
+    Eo = mec/(mec/Ei+1.-chi_m)
+    if Eo<=E_out_low or Eo>E_out_high:
+        return 0.
+    return Eo
+
+# group-angle transfer matrix kernel: integrates the Klein-Nishina integrand
+# over E_in; the angular delta function delta(chi-chi_m) fixes the outgoing
+# energy at E_out* = mec/(lambda_in+1-chi_m), weighted by the Jacobian
+# |dE_out/dchi| = E_out*^2/mec
+# E_in:            energy grid of the incoming group [keV]
+# group_in_step:   energy step of the incoming group [keV]
+# group_in_width:  energy width of the incoming group [keV]
+# E_out_low:       lower (excluded) energy bound of the outgoing group [keV]
+# E_out_high:      upper (included) energy bound of the outgoing group [keV]
+# group_out_step:  energy step of the outgoing group [keV]
+# mec:             electron rest mass [keV]
+# chi_m:           cosine between the incoming and outgoing directions
+@njit(cache=True,fastmath=True)
+def _gatm(E_in,group_in_step,group_in_width,E_out_low,E_out_high,\
+          group_out_step,mec,chi_m):
+# -1 <= chi_m <= 1 guarantees E_min <= E_out* <= E_in, so only the group
+# bounds of E_out* are checked
+    integral_in = 0.
+    for i in range(E_in.shape[0]):
+        Ei = E_in[i]
+        Eo = _delta_E_out(Ei,E_out_low,E_out_high,mec,chi_m)
+        if Eo==0.:
+            continue
+# the outgoing sum over bins of width |group_out_step| becomes an integral
+        integral_out = (Ei/Eo+Eo/Ei-1.+chi_m*chi_m)*Eo*Eo/\
+            (mec*abs(group_out_step))
+        integral_in += group_in_step/(Ei*Ei*group_in_width)*integral_out
+    return integral_in
 
 class MultigroupPhotonCrossSections:
     
     def __init__(self):
-        self.electron_classical_radius_squared_barn = 0.07939827
-        self.electron_rest_mass_keV = 511.006
+        self.electron_classical_radius_squared_barn = _RE2
+        self.electron_rest_mass_keV = _MEC_KEV
         self.group_start = (150,125,100,75,50,25)
         self.group_stop = (125,100,75,50,25,0)
         self.group_step = (-1,-1,-1,-1,-1,-1)
+# energy bins of each group [keV]
+        self._E_grid = [np.arange(self.group_start[g],self.group_stop[g],\
+                                  self.group_step[g],dtype=np.float64) \
+                        for g in range(len(self.group_start))]
+# energy bins of all groups concatenated, and the group of each bin
+        self._E_all = np.concatenate(self._E_grid)
+        self._group_of_E = np.repeat(np.arange(len(self._E_grid)),\
+                                     [len(E) for E in self._E_grid])
 # Biggs F, Lighthill R. Analytical approximations for x-ray cross sections III. 
 # Sandia Natl. Lab., vol. SAND87, no. 70; 1988.        
         
@@ -31,129 +185,293 @@ class MultigroupPhotonCrossSections:
         #             'O':self.element_data['O']['A']/\
         #             (2.*self.element_data['H']['A']+self.element_data['O']['A'])}
         #    }
-        self.photoelectric_cross_sections_fitting_parameters = {
-            'H':pd.DataFrame(
-                data=[[0.01,0.014,1.000E-08,0.,0.,0.],\
-                      [0.014,0.1,-6.383E+01,-6.446E+00,1.317E+01,-5.045E-02],\
-                      [0.1,0.8,3.051E+00,-7.818E+00,1.144E+01,6.959E-02],\
-                      [0.8,4.,7.636E-02,-9.406E-01,6.144E+00,1.425E+00],\
-                      [4.,20.,1.180E-03,-8.236E-02,2.886E+00,5.534E+00],\
-                      [20.,100.,1.620E-05,-5.610E-03,1.214E+00,1.761E+01],\
-                      [100.,500.,1.034E-06,-4.114E-04,6.287E-01,3.927E+01]],\
-                index=[1,2,3,4,5,6,7],\
-                columns=['START','FINISH','A_1','A_2','A_3','A_4']),\
-            'O':pd.DataFrame(
-                data=[[0.01,0.0483,1.144E+04,0.,0.,0.],\
-                      [0.0483,0.532,-2.863E+02,4.085E+02,4.436E+01,-1.782E+00],\
-                      [0.532,4.,-7.181E+01,4.748E+02,5.542E+03,-1.363E+03],\
-                      [4.,20.,2.745E+00,-1.747E+02,7.159E+03,-2.213E+03],\
-                      [20.,100.,3.774E-02,-1.559E+01,4.045E+03,1.810E+04],\
-                      [100.,500.,3.169E-03,1.473E+00,7.214E+02,4.048E+05]],\
-                index=[1,2,3,4,5,6],\
-                columns=['START','FINISH','A_1','A_2','A_3','A_4']),\
-            'Al':pd.DataFrame(
-                data=[[0.01,0.0159,-1.654E+04,1.585E+02,3.907E+00,-3.383E-02],\
-                      [0.0159,0.073,1.122E+03,-4.015E+01,6.623E-01,-2.813E-03],\
-                      [0.073,0.1177,2.390E+04,-6.953E+02,-7.978E+01,1.974E+00],\
-                      [0.1177,1.560,-5.284E+02,1.399E+03,4.360E+02,-4.747E+01],\
-                      [1.560,20.,-3.674E+00,-1.622E+01,2.732E+04,-1.752E+04],\
-                      [20.,100.,4.158E-01,-1.351E+02,2.716E+04,3.723E+02],\
-                      [100.,500.,1.125E-02,2.747E+00,1.174E+04,5.695E+05]],\
-                index=[1,2,3,4,5,6,7],\
-                columns=['START','FINISH','A_1','A_2','A_3','A_4']) 
-                }
+        self.photoelectric_cross_sections_fitting_parameters = dict(_PE_TABLES)
+# fitting parameters stacked in one contiguous array indexed by element id:
+# _pe_table[id,row] = [START,FINISH,A_1,A_2,A_3,A_4], unused rows padded with
+# START = FINISH = +inf; _pe_nrows[id] is the number of rows of the element
+        fitting_parameters = self.photoelectric_cross_sections_fitting_parameters
+        self._elem_id = {element:i for i, element in \
+                         enumerate(fitting_parameters)}
+        self._pe_nrows = np.array([len(table) for table in \
+                                   fitting_parameters.values()],dtype=np.int8)
+        self._pe_table = np.zeros((len(fitting_parameters),\
+                                   self._pe_nrows.max(),6))
+        self._pe_table[:,:,:2] = np.inf
+        for element, table in fitting_parameters.items():
+            self._pe_table[self._elem_id[element],:len(table)] = table
+# contiguous per-element START and A_1..A_4 arrays for the compiled kernels
+        self._pe_starts_by_id = tuple(\
+            np.ascontiguousarray(self._pe_table[i,:n,0]) \
+            for i, n in enumerate(self._pe_nrows))
+        self._pe_coefs_by_id = tuple(\
+            np.ascontiguousarray(self._pe_table[i,:n,2:]) \
+            for i, n in enumerate(self._pe_nrows))
+# fitting domain [START of the first row, FINISH of the last row] [keV]
+        self._pe_domain = tuple(\
+            (self._pe_table[i,0,0],self._pe_table[i,n-1,1]) \
+            for i, n in enumerate(self._pe_nrows))
+# Z/A [mole g^-1] and L*(Z/A) [cm^2 g^-1] of each element
+        self._Z_over_A = {}
+        self._LZoA = {}
+        for element, data in self.element_data.items():
+            self._Z_over_A[element] = data['Z']/data['A']
+            self._LZoA[element] = _L*self._Z_over_A[element]
+# mass absorption, scattering and attenuation coefficients [cm^2 g^-1] of
+# each element over the energy bins of each group, read-only
+        self._mu_abs = {}
+        self._mu_sca = {}
+        self._mu_att = {}
+        for element in self.element_data:
+            self._mu_abs[element] = []
+            self._mu_sca[element] = []
+            self._mu_att[element] = []
+            for g, E in enumerate(self._E_grid):
+                mu_abs = self.get_mass_absorption_coefficient_element(element,E)
+                mu_sca = self.get_mass_scattering_coefficient_element(element,E)
+                mu_att = mu_abs+mu_sca
+                for mu in (mu_abs,mu_sca,mu_att):
+                    mu.setflags(write=False)
+                self._mu_abs[element].append(mu_abs)
+                self._mu_sca[element].append(mu_sca)
+                self._mu_att[element].append(mu_att)
 
 # return the mass absorption coefficient of an element [cm^2 g^-1] 
 # element: chemical symbol of the element ['H','O']
-# E:       energy bin [keV] 
+# E:       energy bin [keV] (scalar or array)
     def get_mass_absorption_coefficient_element(self,element,E):
-        df = self.photoelectric_cross_sections_fitting_parameters[element]
-        A_1 = df[(df['START']<=E) & (df['FINISH']>= E)]['A_1'].values[0]
-        A_2 = df[(df['START']<=E) & (df['FINISH']>= E)]['A_2'].values[0]
-        A_3 = df[(df['START']<=E) & (df['FINISH']>= E)]['A_3'].values[0]
-        A_4 = df[(df['START']<=E) & (df['FINISH']>= E)]['A_4'].values[0]
-        mass_absorption_coefficient = A_1/E+A_2/E**2+A_3/E**3+A_4/E**4
-        return mass_absorption_coefficient
+        eid = self._elem_id[element]
+        if np.isscalar(E):
+            E = float(E)
+            self._check_energy(element,E)
+            return float(_pe_xs(E,self._pe_starts_by_id[eid],\
+                                self._pe_coefs_by_id[eid]))
+        E = np.asarray(E,dtype=np.float64)
+        self._check_energy(element,E)
+        return self._pe_xs_array(eid,E)
+
+# raise ValueError unless every energy (scalar or array) lies in the fitting
+# domain of the element; this also rejects E <= 0 and NaN
+# element: chemical symbol of the element ['H','O']
+# E:       energy bin [keV]
+    def _check_energy(self,element,E):
+        E_low, E_high = self._pe_domain[self._elem_id[element]]
+        if np.isscalar(E):
+            inside = E_low<=E<=E_high
+        else:
+            inside = np.all((E>=E_low)&(E<=E_high))
+        if not inside:
+            raise ValueError('energies of %s must lie in [%g,%g] keV'\
+                             %(element,E_low,E_high))
+
+# photoelectric mass absorption coefficient [cm^2 g^-1] over an energy array
+# eid: element id
+# E:   energy array [keV], already checked to lie in the fitting domain
+    def _pe_xs_array(self,eid,E):
+        table = self._pe_table[eid,:self._pe_nrows[eid]]
+# within the domain only E = START of the first row falls below row 0
+        idx = np.maximum(np.searchsorted(table[:,0],E,side='left')-1,0)
+        A = table[idx,2:]
+        invE = 1./E
+        return invE*(A[...,0]+invE*(A[...,1]+invE*(A[...,2]+invE*A[...,3])))
 
 # return the mass scattering coefficient of an element [cm^2 g^-1] 
 # element: chemical symbol of the element ['H','O']
-# E:       energy bin [keV]    
+# E:       energy bin [keV] (scalar or array)
     def get_mass_scattering_coefficient_element(self,element,E):
-        df = self.element_data[element]
-        Z = df['Z']
-        A = df['A'] # g mole^-1
-        L = 0.40061 # cm^2 mole^-1
-        X = E/511.04
-        R = L*(1.+1.148*X+0.06141*X**2)/(1.+3.171*X+0.9328*X**2+0.02572*X**3)
-        mass_scattering_coefficient = R*(Z/A)
+        X = np.asarray(E,dtype=np.float64)/_MEC_KEV
+        mass_scattering_coefficient = self._LZoA[element]*_scattering_fit(X)
+        if np.isscalar(E):
+            return float(mass_scattering_coefficient)
         return mass_scattering_coefficient
     
 # return the Klein-Nishina mass scattering coefficient of an element [cm^2 g^-1] 
 # element: chemical symbol of the element ['H','O']
-# E:       energy bin [keV]    
+# E:       energy bin [keV] (scalar or array)
     def get_KN_mass_scattering_coefficient_element(self,element,E):
-        df = self.element_data[element]
-        Z = df['Z']
-        A = df['A'] # g mole^-1
-        L = 0.40061 # cm^2 mole^-1
-        X = E/511.04
-        omega = 1./(1.+2*X)
-        R = (3/4)*L*(((2.+2.*X-X**2)/(2.*X**3))*np.log(omega)+\
-                     2.*omega*(1.+X)**2/X**2-omega**2*(1.+3*X))
-        mass_scattering_coefficient = R*(Z/A)
+        LZoA = self._LZoA[element]
+        X = np.asarray(E,dtype=np.float64)/_MEC_KEV
+        invX = 1./X
+        opX = 1.+X
+        inv_op2X = 1./(1.+2.*X)
+        L1 = np.log1p(2.*X)
+        mass_scattering_coefficient = 0.75*LZoA*\
+            (opX*invX*invX*(2.*opX*inv_op2X-L1*invX)+0.5*L1*invX-\
+             (1.+3.*X)*inv_op2X*inv_op2X)
+        if np.isscalar(E):
+            return float(mass_scattering_coefficient)
         return mass_scattering_coefficient
     
 # return the mass attenuation coefficient of an element [cm^2 g^-1] 
 # element: chemical symbol of the element ['H','O']
-# E:       energy bin [keV]    
+# E:       energy bin [keV] (scalar or array)
     def get_mass_attenuation_coefficient_element(self,element,E):    
-        mass_absorption_coefficient = \
-            self.get_mass_absorption_coefficient_element(element,E)
-        mass_scattering_coefficient = \
-            self.get_mass_scattering_coefficient_element(element,E)
-        mass_attenuation_coefficient = \
-            mass_absorption_coefficient+mass_scattering_coefficient
-        return mass_attenuation_coefficient
+        return self._mu_total(element,E)
+
+# mass attenuation coefficient of an element [cm^2 g^-1]: a scalar E goes
+# through the compiled kernel, an array shares the conversion of E between
+# the absorption and scattering fits
+    def _mu_total(self,element,E):
+        eid = self._elem_id[element]
+        if np.isscalar(E):
+            E = float(E)
+            self._check_energy(element,E)
+            return float(_mu_total_xs(E,self._pe_starts_by_id[eid],\
+                                      self._pe_coefs_by_id[eid],\
+                                      float(self._LZoA[element])))
+        E = np.asarray(E,dtype=np.float64)
+        self._check_energy(element,E)
+        return self._pe_xs_array(eid,E)+\
+            self._LZoA[element]*_scattering_fit(E/_MEC_KEV)
+
+# return the mass absorption coefficients of an element [cm^2 g^-1] over the
+# energy bins of a group (precomputed read-only table)
+# element: chemical symbol of the element ['H','O']
+# g:       group index
+    def get_mass_absorption_coefficient_element_group(self,element,g):
+        return self._mu_abs[element][g]
+
+# return the mass scattering coefficients of an element [cm^2 g^-1] over the
+# energy bins of a group (precomputed read-only table)
+# element: chemical symbol of the element ['H','O']
+# g:       group index
+    def get_mass_scattering_coefficient_element_group(self,element,g):
+        return self._mu_sca[element][g]
+
+# return the mass attenuation coefficients of an element [cm^2 g^-1] over the
+# energy bins of a group (precomputed read-only table)
+# element: chemical symbol of the element ['H','O']
+# g:       group index
+    def get_mass_attenuation_coefficient_element_group(self,element,g):
+        return self._mu_att[element][g]
     
 # return the mass absorption coefficient of a compound [cm^2 g^-1] 
-# compound: weight fraction of each element in the compound
-# E:       energy bin [keV] 
+# compound: weight fraction of each element in the compound, e.g.
+#           {'H':0.1119,'O':0.8881}
+# E:       energy bin [keV] (scalar or array)
     def get_mass_absorption_coefficient_compound(self,compound,E):
-        pass
+        if not compound:
+            raise ValueError('compound must contain at least one element')
+        unknown = sorted(set(compound)-set(self._elem_id))
+        if unknown:
+            raise ValueError('unknown elements in compound: %s'\
+                             %', '.join(unknown))
+        elements, weights = _compound_weights(tuple(sorted(compound.items())))
+        mass_absorption_coefficients = np.stack(\
+            [self.get_mass_absorption_coefficient_element(element,E) \
+             for element in elements])
+        mass_absorption_coefficient = weights@mass_absorption_coefficients
+        if np.isscalar(E):
+            return float(mass_absorption_coefficient)
+        return mass_absorption_coefficient
         
         
+# return the group-angle transfer matrix element [barn keV^-1]
+# group_in, group_out:         indices of the incoming and outgoing groups
+# direction_in, direction_out: unit vectors of the incoming and outgoing 
+#                              directions
     def get_group_angle_transfer_matrix_element(self,group_in,group_out,direction_in,direction_out):        
-        chi_m = np.dot(direction_in,direction_out)
-        group_angle_transfer_matrix_element = 0.
+        chi_m = _scattering_cosine(direction_in,direction_out)
         group_in_start = self.group_start[group_in]
         group_in_stop = self.group_stop[group_in]
         group_in_step = self.group_step[group_in]
-        group_out_start = self.group_start[group_out]
-        group_out_stop = self.group_stop[group_out]
         group_out_step = self.group_step[group_out]
-        integral_in = 0.
-        for E_in in np.arange(group_in_start,group_in_stop,group_in_step):
-            #print('E_in=',E_in)
-            lambda_in = self.electron_rest_mass_keV/E_in
-            integral_out = 0.
-            for E_out in np.arange(group_out_start,group_out_stop,group_out_step):
-                #print('E_out=',E_out)
-                E_max = E_in
-                E_min = E_in/(1.+2./lambda_in)
-                #print('E_max=',E_max)
-                #print('E_min=',E_min)
-                if((E_out<=E_max)&(E_out>=E_min)):
-                    print('E_in=',E_in,'E_out=',E_out,'E_max=',E_max,'E_min=',E_min)
-                    lambda_out = self.electron_rest_mass_keV/E_out
-                    chi = 1.+lambda_in-lambda_out
-                    print('chi=',chi)
-                    if(chi==chi_m):
-                        integral_out += E_in/E_out+E_out/E_in-1.+chi**2
-            integral_in += group_in_step/(E_in**2*(group_in_start-group_in_stop))*integral_out
+        E_in = self._E_grid[group_in]
+        integral_in = _gatm(E_in,float(group_in_step),\
+                            float(group_in_start-group_in_stop),\
+                            float(self.group_stop[group_out]),\
+                            float(self.group_start[group_out]),\
+                            float(group_out_step),\
+                            float(self.electron_rest_mass_keV),chi_m)
+        if _LOG.isEnabledFor(logging.DEBUG):
+# the points summed by the kernel: E_out* inside the outgoing group
+            for Ei in E_in:
+                Eo = _delta_E_out(float(Ei),float(self.group_stop[group_out]),\
+                                  float(self.group_start[group_out]),\
+                                  float(self.electron_rest_mass_keV),chi_m)
+                if Eo!=0.:
+                    _LOG.debug("E_in=%g E_out*=%g chi_m=%g",Ei,Eo,chi_m)
         group_angle_transfer_matrix_element = 0.5*self.electron_classical_radius_squared_barn*self.electron_rest_mass_keV*integral_in    
         return group_angle_transfer_matrix_element
-        
-        
-        
-        
-        
\ No newline at end of file
+
+# sample the cosine of the Compton scattering angle from the Klein-Nishina
+# distribution by the composition-rejection method of Hua et al. (1997)
+# E:   energy of the incoming photon [keV] (scalar or array)
+# rng: random number generator (np.random.Generator)
+    def sample_compton_cos_theta(self,E,rng):
+        X = np.atleast_1d(np.asarray(E,dtype=np.float64))/\
+            self.electron_rest_mass_keV
+# a zero, negative, infinite or NaN energy would never be accepted by the
+# rejection loop, or would give a degenerate sample
+        if np.any(~((X>0.)&np.isfinite(X))):
+            raise ValueError('photon energies must be positive and finite')
+        cos_theta = np.empty_like(X)
+        pending = np.arange(X.size)
+        while pending.size>0:
+            x = X.flat[pending]
+# epsilon = E_out/E_in lies in [epsilon_0,1]
+            epsilon_0 = 1./(1.+2.*x)
+            alpha_1 = np.log1p(2.*x)
+            alpha_2 = 2.*x*(1.+x)*epsilon_0**2
+            r_1, r_2, r_3 = rng.random((3,pending.size))
+            epsilon = np.where(r_1<alpha_1/(alpha_1+alpha_2),\
+                               np.exp(-alpha_1*r_2),\
+                               np.sqrt(epsilon_0**2+(1.-epsilon_0**2)*r_2))
+            one_minus_cos = (1.-epsilon)/(epsilon*x)
+            sin2 = one_minus_cos*(2.-one_minus_cos)
+            accepted = r_3<=1.-epsilon*sin2/(1.+epsilon**2)
+            cos_theta.flat[pending[accepted]] = 1.-one_minus_cos[accepted]
+            pending = pending[~accepted]
+        if np.isscalar(E):
+            return float(cos_theta[0])
+        return cos_theta.reshape(np.shape(E))
+
+# return the group-angle transfer probabilities estimated by Monte Carlo:
+# probability that a photon of group_in is Compton scattered into group_out
+# with a scattering cosine in each of n_mu equal bins on [-1,1]
+# n_mu:      number of scattering-cosine bins
+# n_samples: number of sampled scatterings per incoming group
+# rng:       random number generator (np.random.Generator)
+    def sample_group_angle_transfer_matrix(self,n_mu,n_samples,rng):
+        n_groups = len(self.group_start)
+        group_stop = np.asarray(self.group_stop,dtype=np.float64)
+        transfer_matrix = np.zeros((n_groups,n_groups,n_mu))
+        for group_in in range(n_groups):
+            E_in = rng.choice(self._E_grid[group_in],n_samples)
+            cos_theta = self.sample_compton_cos_theta(E_in,rng)
+            E_out = E_in/(1.+E_in/self.electron_rest_mass_keV*(1.-cos_theta))
+# group g holds the energies group_stop[g] < E <= group_start[g]
+            group_out = np.sum(group_stop[None,:]>=E_out[:,None],axis=1)
+            mu_bin = np.minimum(((cos_theta+1.)*0.5*n_mu).astype(int),n_mu-1)
+            counts = np.bincount(group_out*n_mu+mu_bin,\
+                                 minlength=n_groups*n_mu)
+            transfer_matrix[group_in] = counts.reshape(n_groups,n_mu)/n_samples
+        return transfer_matrix
+
+# return the group-angle transfer matrix [barn keV^-1] between all groups:
+# element [group_in,group_out] equals 
+# get_group_angle_transfer_matrix_element(group_in,group_out,...)
+# direction_in, direction_out: unit vectors of the incoming and outgoing 
+#                              directions
+    def build_transfer_matrix(self,direction_in,direction_out):
+        chi_m = _scattering_cosine(direction_in,direction_out)
+        n_groups = len(self.group_start)
+        group_start = np.asarray(self.group_start,dtype=np.float64)
+        group_stop = np.asarray(self.group_stop,dtype=np.float64)
+        group_step = np.asarray(self.group_step,dtype=np.float64)
+        mec = self.electron_rest_mass_keV
+        E_in = self._E_all
+        group_in = self._group_of_E
+# outgoing energy fixed by the angular delta function, and its group
+        E_out = mec/(mec/E_in+1.-chi_m)
+        group_out = np.sum(group_stop[None,:]>=E_out[:,None],axis=1)
+        integrand = group_step[group_in]/\
+            (E_in**2*(group_start-group_stop)[group_in])*\
+            (E_in/E_out+E_out/E_in-1.+chi_m**2)*E_out**2/\
+            (mec*np.abs(group_step)[group_out])
+        integral_in = np.bincount(group_in*n_groups+group_out,\
+                                  weights=integrand,\
+                                  minlength=n_groups*n_groups)
+        group_angle_transfer_matrix = 0.5*\
+            self.electron_classical_radius_squared_barn*mec*\
+            integral_in.reshape(n_groups,n_groups)
+        return group_angle_transfer_matrix
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the multigroup photon cross sections
+"""
+
+import logging
+
+import numpy as np
+import pytest
+
+from multigroup_cross_sections import MultigroupPhotonCrossSections
+
+@pytest.fixture(scope='module')
+def cross_sections():
+    return MultigroupPhotonCrossSections()
+
+# the full matrix must equal the per-element method for every group pair
+@pytest.mark.parametrize('chi_m',[1.,0.9,0.,-0.5,-1.])
+def test_build_transfer_matrix_matches_elements(cross_sections,chi_m):
+    direction_in = [1.,0.,0.]
+    direction_out = [chi_m,np.sqrt(1.-chi_m**2),0.]
+    n_groups = len(cross_sections.group_start)
+    element_matrix = np.array(\
+        [[cross_sections.get_group_angle_transfer_matrix_element(\
+            group_in,group_out,direction_in,direction_out) \
+          for group_out in range(n_groups)] for group_in in range(n_groups)])
+    transfer_matrix = cross_sections.build_transfer_matrix(direction_in,\
+                                                           direction_out)
+    np.testing.assert_allclose(transfer_matrix,element_matrix,\
+                               rtol=1e-12,atol=1e-16)
+
+@pytest.mark.parametrize('direction_in,direction_out',\
+    [([0.5,0.,0.],[1.,0.,0.]),([2.,0.,0.],[0.,1.,0.]),\
+     ([1.,0.,0.],[2.,0.,0.])])
+def test_transfer_matrix_rejects_non_unit_directions(cross_sections,\
+                                                     direction_in,\
+                                                     direction_out):
+    with pytest.raises(ValueError):
+        cross_sections.build_transfer_matrix(direction_in,direction_out)
+    with pytest.raises(ValueError):
+        cross_sections.get_group_angle_transfer_matrix_element(\
+            0,0,direction_in,direction_out)
+
+# energies outside the fitting domain [0.01,500] keV, zero, negative or NaN
+@pytest.mark.parametrize('E',[0.,-5.,np.nan,0.005,600.,np.inf])
+def test_absorption_rejects_energies_outside_domain(cross_sections,E):
+    with pytest.raises(ValueError):
+        cross_sections.get_mass_absorption_coefficient_element(\
+            'O',np.array([10.,E]))
+    with pytest.raises(ValueError):
+        cross_sections.get_mass_absorption_coefficient_element('O',E)
+
+# the edges of the fitting domain are accepted
+def test_absorption_accepts_domain_edges(cross_sections):
+    mu = cross_sections.get_mass_absorption_coefficient_element(\
+        'H',np.array([0.01,500.]))
+    assert np.all(np.isfinite(mu))
+    for E in (0.01,500.):
+        assert np.isfinite(\
+            cross_sections.get_mass_absorption_coefficient_element('H',E))
+
+# the compiled scalar lookup and the array lookup agree
+def test_absorption_scalar_matches_array(cross_sections):
+    E = np.array([0.01,0.05,1.,4.,20.,35.5,100.,150.,500.])
+    for element in ('H','O','Al'):
+        mu = cross_sections.get_mass_absorption_coefficient_element(element,E)
+        mu_scalar = [cross_sections.get_mass_absorption_coefficient_element(\
+            element,float(e)) for e in E]
+        np.testing.assert_allclose(mu_scalar,mu,rtol=1e-12)
+
+# scalar and array attenuation share one error path
+@pytest.mark.parametrize('E',[0.,-5.,np.nan,600.])
+def test_attenuation_rejects_energies_outside_domain(cross_sections,E):
+    with pytest.raises(ValueError):
+        cross_sections.get_mass_attenuation_coefficient_element('O',E)
+    with pytest.raises(ValueError):
+        cross_sections.get_mass_attenuation_coefficient_element(\
+            'O',np.array([E]))
+
+# the debug log lists only the points summed into the outgoing group
+def test_transfer_matrix_debug_log_within_group(cross_sections,caplog):
+    caplog.set_level(logging.DEBUG,logger='multigroup_cross_sections')
+    cross_sections.get_group_angle_transfer_matrix_element(\
+        0,1,[1.,0.,0.],[0.,1.,0.])
+    E_out = [float(record.getMessage().split()[1].split('=')[1]) \
+             for record in caplog.records]
+    assert len(E_out)>0
+    assert all(100.<Eo<=125. for Eo in E_out)
+
+# the compound coefficient is the weighted sum of the element coefficients
+def test_compound_absorption_is_weighted_sum(cross_sections):
+    compound = {'H':0.1119,'O':0.8881}
+    E = np.array([10.,30.,100.])
+    expected = sum(weight*\
+        cross_sections.get_mass_absorption_coefficient_element(element,E) \
+        for element, weight in compound.items())
+    np.testing.assert_allclose(\
+        cross_sections.get_mass_absorption_coefficient_compound(compound,E),\
+        expected,rtol=1e-12)
+
+@pytest.mark.parametrize('compound',[{},{'H':0.5,'Xx':0.5}])
+def test_compound_absorption_rejects_invalid_compound(cross_sections,\
+                                                      compound):
+    with pytest.raises(ValueError):
+        cross_sections.get_mass_absorption_coefficient_compound(compound,30.)
+
+# sampled scattering cosines follow the Klein-Nishina density (chi-square
+# test on 40 bins, critical value 73.40 for 39 degrees of freedom at p=0.001)
+@pytest.mark.parametrize('E',[10.,100.,1000.,5000.])
+def test_sample_compton_cos_theta_follows_klein_nishina(cross_sections,E):
+    rng = np.random.default_rng(12345)
+    n_samples = 200000
+    n_bins = 40
+    cos_theta = cross_sections.sample_compton_cos_theta(\
+        np.full(n_samples,E),rng)
+    assert np.all((cos_theta>=-1.)&(cos_theta<=1.))
+    counts, edges = np.histogram(cos_theta,bins=n_bins,range=(-1.,1.))
+    x = E/cross_sections.electron_rest_mass_keV
+    mu = np.linspace(-1.,1.,n_bins*200+1)
+    P = 1./(1.+x*(1.-mu))
+    density = P**2*(P+1./P-(1.-mu**2))
+# integrate the density over each bin with the trapezoidal rule
+    segments = 0.5*(density[1:]+density[:-1])*np.diff(mu)
+    probabilities = segments.reshape(n_bins,200).sum(axis=1)
+    expected = n_samples*probabilities/probabilities.sum()
+    chi2 = np.sum((counts-expected)**2/expected)
+    assert chi2<73.40
+
+@pytest.mark.parametrize('E',[0.,-1.,np.nan,np.inf])
+def test_sample_compton_cos_theta_rejects_invalid_energies(cross_sections,E):
+    rng = np.random.default_rng(0)
+    with pytest.raises(ValueError):
+        cross_sections.sample_compton_cos_theta(E,rng)
+    with pytest.raises(ValueError):
+        cross_sections.sample_compton_cos_theta(np.array([10.,E]),rng)
+
+# every incoming group scatters into some (group_out,mu bin) pair
+def test_sample_group_angle_transfer_matrix_is_normalized(cross_sections):
+    rng = np.random.default_rng(2025)
+    transfer_matrix = cross_sections.sample_group_angle_transfer_matrix(\
+        8,20000,rng)
+    n_groups = len(cross_sections.group_start)
+    assert transfer_matrix.shape==(n_groups,n_groups,8)
+    assert np.all(transfer_matrix>=0.)
+    np.testing.assert_allclose(transfer_matrix.sum(axis=(1,2)),1.,rtol=1e-12)
+# Compton scattering only lowers the energy
+    assert np.all(np.tril(transfer_matrix.sum(axis=2),-1)==0.)